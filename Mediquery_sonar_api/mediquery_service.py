@@ -1,16 +1,49 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 import httpx
-import json
+import orjson
 import os
 from dotenv import load_dotenv
-from uuid import UUID
-import traceback
+from typing import NamedTuple
+import msgspec
+import logging
+import logging.handlers
+import queue
+import socket
+import types
+import fcntl
+import time
+import asyncio
+import hashlib
+import re
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import faiss
+import numpy as np
+from fastembed import TextEmbedding
 load_dotenv()
 
+# === Logging ===
+# Records are handed to a queue and written by a listener thread, so a slow
+# stderr never blocks the event loop. Debug payload dumps are off unless
+# LOG_LEVEL=DEBUG.
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+
 app = FastAPI(debug=True)
 
+@app.on_event("startup")
+async def start_log_listener():
+    log_listener.start()
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -21,215 +54,774 @@ app.add_middleware(
 )
 
 # === Predefined topic -> domain mappings ===
-DOMAIN_FILTERS_BY_TOPIC = {
-    "drug_info": ["drugs.com", "rxlist.com"],
-    "symptoms": ["mayoclinic.org", "clevelandclinic.org"],
-    "treatment_guidelines": ["msdmanuals.com", "cdc.gov"],
-    "public_health": ["cdc.gov", "who.int"],
-    "clinical_research": ["pubmed.ncbi.nlm.nih.gov", "nejm.org"]
-}
+# Read-only and tuple-valued so the filters can go straight into Sonar payloads
+# (orjson encodes tuples as arrays) without defensive copies.
+DOMAIN_FILTERS_BY_TOPIC = types.MappingProxyType({
+    "drug_info": ("drugs.com", "rxlist.com"),
+    "symptoms": ("mayoclinic.org", "clevelandclinic.org"),
+    "treatment_guidelines": ("msdmanuals.com", "cdc.gov"),
+    "public_health": ("cdc.gov", "who.int"),
+    "clinical_research": ("pubmed.ncbi.nlm.nih.gov", "nejm.org"),
+    "diagnosis_support": ("msdmanuals.com", "bestpractice.bmj.com")
+})
 
-# === Request/Response Models ===
-class Usage(BaseModel):
-    prompt_tokens: int
-    completion_tokens: int
-    total_tokens: int
-    search_context_size: str
+# Obviously out-of-scope input is rejected before any classification work
+MIN_QUESTION_LENGTH = 5
+_QUICK_REJECT = re.compile(r"^\s*(hi|hello|hey|test(ing)?|thanks|thank you|ok(ay)?|yes|no|bye)[\s!.?]*$", re.I)
 
+# === Local topic classification ===
+# Tried before spending a Sonar call on classification: the question embedding is
+# compared with a short description per topic, including a non-medical "Unknown"
+# one so out-of-scope questions are rejected locally. Keyword patterns only break
+# ties between medical topics; on their own they also match non-medical text
+# ("how do I treat rust on my car"), so they must agree with the embedding scores.
+TOPIC_KEYWORDS = {
+    "drug_info": re.compile(r"\b(dos(e|es|age|ing)|mg|tablets?|pills?|side effects?|interactions?|contraindications?|overdose|medications?|drugs?)\b", re.I),
+    "symptoms": re.compile(r"\b(symptoms?|signs? of|fever|cough|rash|dizz(y|iness)|nausea|swelling|itch(y|ing)?)\b", re.I),
+    "treatment_guidelines": re.compile(r"\b(treat(ment|ments|ed|ing)?|guidelines?|therap(y|ies)|first[- ]line|protocols?)\b", re.I),
+    "public_health": re.compile(r"\b(vaccin(e|es|ation)|outbreaks?|epidemics?|pandemics?|prevalence|immuni[sz]ation|public health|transmission)\b", re.I),
+    "clinical_research": re.compile(r"\b(stud(y|ies)|trials?|research|meta-analys[ie]s|randomi[sz]ed|cohort)\b", re.I),
+    "diagnosis_support": re.compile(r"\b(diagnos(e|ed|is|tic)|differential|what could (this|it) be)\b", re.I),
+}
+TOPIC_DESCRIPTIONS = {
+    "drug_info": "Medication information: dosage, side effects, drug interactions and contraindications.",
+    "symptoms": "Symptoms and warning signs of a disease or medical condition.",
+    "treatment_guidelines": "How a medical condition is treated or managed according to clinical guidelines.",
+    "public_health": "Public health topics: vaccination, disease outbreaks, prevention and population health.",
+    "clinical_research": "Clinical research: medical studies, clinical trials and scientific evidence.",
+    "diagnosis_support": "Diagnosis support: which condition could explain a set of findings and how it is diagnosed.",
+    "Unknown": "Questions unrelated to health or medicine, such as cars, home repair, cooking, technology, money, sports or travel.",
+}
+# These are raw all-MiniLM-L6-v2 cosine similarities, not zero-shot probabilities:
+# a short question typically scores about 0.4-0.7 against a description of its own
+# topic and below 0.2 against unrelated text. A label is used only when it clears
+# the floor and beats the next best label by the margin; anything closer goes to
+# Sonar. Tune both against logged remote classifications.
+LOCAL_CLASSIFIER_MIN_COSINE = 0.4
+LOCAL_CLASSIFIER_MARGIN = 0.05
+# When classification has to go to Sonar and the local best guess is one of these
+# common topics, the answer query is started with its domains in parallel
+SPECULATIVE_TOPICS = {"public_health", "symptoms"}
 
-class Message(BaseModel):
-    role: str
-    content: str
+# === Exact-match response cache ===
+# Keyed by the normalized question; values are futures so concurrent duplicate
+# questions share the one in-flight Sonar call instead of each paying for it.
+RESPONSE_CACHE_MAXSIZE = 2048
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE = TTLCache(maxsize=RESPONSE_CACHE_MAXSIZE, ttl=RESPONSE_CACHE_TTL)
 
+# === Semantic response cache ===
+# Catches paraphrases the exact-match cache misses: questions are embedded with a
+# small local model and matched by cosine similarity (inner product of unit vectors).
+# Entries expire and are capped like the exact-match cache, so a paraphrase (or an
+# exact repeat, which scores 1.0) never outlives the answer's TTL.
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAXSIZE = RESPONSE_CACHE_MAXSIZE
+SEMANTIC_CACHE_TTL = RESPONSE_CACHE_TTL
+# A full cache is pruned down to this size in one index rebuild, so the rebuild
+# cost is spread over the next few hundred adds instead of paid on each one
+SEMANTIC_CACHE_PRUNE_TO = SEMANTIC_CACHE_MAXSIZE * 9 // 10
+# Neighbours checked per lookup, so an expired top match doesn't hide a fresh one
+SEMANTIC_CACHE_SEARCH_K = 4
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", "semantic_cache")
+SEMANTIC_CACHE_PERSIST_INTERVAL = 300
 
-class Delta(BaseModel):
-    role: str
+# === Request/Response Models ===
+# Upstream Sonar completions are decoded straight from bytes with msgspec;
+# only the fields the service uses are declared, everything else is skipped.
+class Message(msgspec.Struct):
     content: str
 
 
-class Choice(BaseModel):
-    index: int
-    finish_reason: str
+class Choice(msgspec.Struct):
     message: Message
-    delta: Delta
 
 
-class CompletionResponse(BaseModel):
-    id: UUID
-    model: str
-    created: int
-    usage: Usage
-    citations: list[str]
-    object: str
+class CompletionResponse(msgspec.Struct):
     choices: list[Choice]
+    citations: list[str] = []
+
+
+class SonarAnswer(NamedTuple):
+    content: str
+    citations: list[str]
 
+# Pydantic models whose JSON schema is sent to Sonar as response_format
 class TopicFormat(BaseModel):
     topic_name: str
 
+class TopicBatchFormat(BaseModel):
+    topic_names: list[str]
+
 class QueryRequest(BaseModel):
     question: str
 
-class QueryResponse(BaseModel):
+# Shared between requests through the caches, hence frozen
+class QueryResponse(msgspec.Struct, frozen=True):
     topic: str
-    domain_filter: list
+    domain_filter: tuple[str, ...]
     answer: str
-    citations: list
+    citations: list[str]
+
+# Each entry carries its own vector and question key, so a persisted cache is a
+# single self-consistent file that workers can merge by key
+class SemanticCacheEntry(msgspec.Struct, frozen=True):
+    key: str
+    created: float
+    vector: bytes
+    response: QueryResponse
+
+class MsgspecJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return msgspec.json.encode(content)
+
+# OpenAPI schema for QueryResponse, since FastAPI can't derive one from a Struct
+# (it has no nested models, so its component can be inlined as-is)
+QUERY_RESPONSE_SCHEMA = msgspec.json.schema_components([QueryResponse])[1]["QueryResponse"]
+
+# === Static Sonar payload parts ===
+# Built once at import; per-request payloads only add the messages (and domains).
+TOPIC_JSON_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {"schema": TopicFormat.model_json_schema()},
+}
+
+_CLASSIFY_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "Classify the user medical question into one of these categories: drug_info, symptoms, treatment_guidelines, public_health, clinical_research, diagnosis_support, Unknown. Ensure to strictly return one of these values."
+}
+
+_CLASSIFY_BATCH_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "The user message is a JSON array of medical questions. Classify each question into one of these categories: drug_info, symptoms, treatment_guidelines, public_health, clinical_research, diagnosis_support, Unknown. Return topic_names with exactly one category per question, in the same order as the questions. Ensure to strictly use these values."
+}
+
+_CLASSIFY_PAYLOAD_BASE = {
+    "model": "sonar-pro",
+    "max_tokens": 50,
+    "temperature": 0.2,
+    "top_p": 0.9,
+    "search_domain_filter": [],
+    "return_images": False,
+    "return_related_questions": False,
+    "top_k": 0,
+    "stream": False,
+    "presence_penalty": 0,
+    "frequency_penalty": 1,
+    "response_format": TOPIC_JSON_SCHEMA,
+    "web_search_options": {"search_context_size": "low"}
+}
+
+_CLASSIFY_BATCH_PAYLOAD_BASE = {
+    **_CLASSIFY_PAYLOAD_BASE,
+    "response_format": {
+        "type": "json_schema",
+        "json_schema": {"schema": TopicBatchFormat.model_json_schema()},
+    }
+}
+
+_QUERY_PAYLOAD_BASE = {
+    "model": "sonar-pro",
+    "max_tokens": 5000,
+    "temperature": 0.2,
+    "top_p": 0.9,
+    "return_images": False,
+    "return_related_questions": False,
+    "top_k": 0,
+    "stream": False,
+    "presence_penalty": 0,
+    "frequency_penalty": 1,
+    "web_search_options": {"search_context_size": "low"},
+    "chain_of_thought": True,
+    "include_citations": True
+}
 
 # === Environment variable for API key ===
 SONAR_API_KEY = os.getenv("SONAR_API_KEY")
-SONAR_API_URL = "https://api.perplexity.ai/chat/completions"
+SONAR_API_BASE_URL = "https://api.perplexity.ai"
+SONAR_API_PATH = "/chat/completions"
+SONAR_API_URL = SONAR_API_BASE_URL + SONAR_API_PATH
 
-async def classify_topic(question: str) -> str:
-    print(f"Classifying topic: {question}")
-    try:
-        payload = {
-            "model": "sonar-pro",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "Classify the user medical question into one of these categories: drug_info, symptoms, treatment_guidelines, public_health, clinical_research, diagnosis_support, Unknown. Ensure to strictly return one of these values."
-                },
-                {
-                    "role": "user",
-                    "content": question
-                }
-            ],
-            "max_tokens": 50,
-            "temperature": 0.2,
-            "top_p": 0.9,
-            "search_domain_filter": [],
-            "return_images": False,
-            "return_related_questions": False,
-            "top_k": 0,
-            "stream": False,
-            "presence_penalty": 0,
-            "frequency_penalty": 1,
-            "response_format": {
-                "type": "json_schema",
-                "json_schema": {"schema": TopicFormat.model_json_schema()},
-            },
-            "web_search_options": {"search_context_size": "low"}
+# === Shared HTTP client ===
+# Bounded timeouts keep a hung upstream from holding a pooled connection for
+# long; the small pool timeout turns saturation into a fast 503 instead of a hang.
+SONAR_TIMEOUT = httpx.Timeout(connect=5.0, read=120.0, write=10.0, pool=5.0)
+
+# One pooled client per process so repeated /ask calls reuse keep-alive
+# connections to the Sonar API instead of paying a TCP + TLS handshake each time.
+# HTTP/2 lets concurrent classify and query calls multiplex over one connection,
+# and TCP_NODELAY keeps small request bodies from waiting on Nagle's algorithm.
+@app.on_event("startup")
+async def create_sonar_client():
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0),
+        socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+    )
+    app.state.sonar_client = httpx.AsyncClient(
+        base_url=SONAR_API_BASE_URL,
+        transport=transport,
+        timeout=SONAR_TIMEOUT,
+        headers={
+            "Authorization": f"Bearer {SONAR_API_KEY}",
+            "Content-Type": "application/json"
         }
-        
-        print(f"\n=== Classification Request Details ===")
-        print(f"URL: {SONAR_API_URL}")
-        print(f"Payload: {json.dumps(payload, indent=2)}")
+    )
 
-        async with httpx.AsyncClient() as client:
-            try:
-                resp = await client.post(
-                    SONAR_API_URL,
-                    headers={
-                        "Authorization": f"Bearer {SONAR_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json=payload
-                )
-                print(f"\n=== Classification Response Details ===")
-                print(f"Status Code: {resp.status_code}")
-                print(f"Headers: {dict(resp.headers)}")
-                print(f"Response Text: {resp.text[:1000]}...")  # Print first 1000 chars of response
-                
-                resp.raise_for_status()
-                result = resp.json()
-                output = CompletionResponse.model_validate(result)
-                topic = TopicFormat.model_validate(json.loads(output.choices[0].message.content))
-                print(f"\n=== Classification Result ===")
-                print(f"Detected Topic: {topic.topic_name}")
-                return topic.topic_name
-            except httpx.HTTPError as http_err:
-                print(f"\n=== HTTP Error Details ===")
-                print(f"HTTP Error occurred: {http_err}")
-                print(f"Error Response: {getattr(http_err, 'response', None)}")
-                print(f"Request Info: {getattr(http_err, 'request', None)}")
-                raise
+# Strong references to the detached producers, which asyncio itself doesn't keep;
+# cancelled before the client they stream from is closed
+ANSWER_STREAM_TASKS: set[asyncio.Task] = set()
+
+@app.on_event("shutdown")
+async def cancel_answer_streams():
+    for task in ANSWER_STREAM_TASKS:
+        task.cancel()
+    await asyncio.gather(*ANSWER_STREAM_TASKS, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def close_sonar_client():
+    await app.state.sonar_client.aclose()
+
+def embed(embedder: TextEmbedding, texts: list[str]) -> np.ndarray:
+    vecs = np.asarray(list(embedder.embed(texts)), dtype=np.float32)
+    faiss.normalize_L2(vecs)
+    return vecs
+
+def retain_semantic_entries(entries: list[SemanticCacheEntry], limit: int = SEMANTIC_CACHE_MAXSIZE) -> list[SemanticCacheEntry]:
+    # Drop expired entries and keep at most limit newest, oldest first
+    expiry = time.time() - SEMANTIC_CACHE_TTL
+    fresh = sorted((entry for entry in entries if entry.created > expiry), key=lambda entry: entry.created)
+    return fresh[-limit:]
+
+class SemanticCache:
+    def __init__(self, embedder: TextEmbedding, directory: str):
+        self.embedder = embedder
+        self.path = os.path.join(directory, "entries.msgpack")
+        self.lock_path = os.path.join(directory, "entries.lock")
+        self.index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        self.entries: list[SemanticCacheEntry] = []
+        self.lock = asyncio.Lock()
+        self.dirty = False
+
+    async def lookup(self, question: str) -> tuple[np.ndarray, QueryResponse | None]:
+        vec = await asyncio.to_thread(embed, self.embedder, [question])
+        async with self.lock:
+            if self.index.ntotal == 0:
+                return vec, None
+            scores, ids = self.index.search(vec, min(SEMANTIC_CACHE_SEARCH_K, self.index.ntotal))
+            expiry = time.time() - SEMANTIC_CACHE_TTL
+            for score, i in zip(scores[0], ids[0]):
+                if score <= SEMANTIC_CACHE_THRESHOLD:
+                    break
+                if self.entries[i].created > expiry:
+                    return vec, self.entries[i].response
+        return vec, None
+
+    async def add(self, vec: np.ndarray, key: str, response: QueryResponse):
+        async with self.lock:
+            self.entries.append(SemanticCacheEntry(key=key, created=time.time(), vector=vec.tobytes(), response=response))
+            if len(self.entries) > SEMANTIC_CACHE_MAXSIZE:
+                self.set_entries(retain_semantic_entries(self.entries, SEMANTIC_CACHE_PRUNE_TO))
+            else:
+                self.index.add(vec)
+            self.dirty = True
+
+    async def prune(self):
+        # Expired entries are already skipped by lookup; dropping them is only
+        # housekeeping, done periodically rather than on the add path
+        async with self.lock:
+            if self.entries and self.entries[0].created <= time.time() - SEMANTIC_CACHE_TTL:
+                self.set_entries(retain_semantic_entries(self.entries))
+
+    def set_entries(self, entries: list[SemanticCacheEntry]):
+        # Rebuild the index so its ids line up with self.entries again
+        self.entries = entries
+        self.index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        if entries:
+            vectors = np.frombuffer(b"".join(entry.vector for entry in entries), dtype=np.float32)
+            self.index.add(vectors.reshape(-1, EMBEDDING_DIM))
+
+    def read(self) -> list[SemanticCacheEntry]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as f:
+            return msgspec.msgpack.decode(f.read(), type=list[SemanticCacheEntry])
+
+    def load(self):
+        self.set_entries(retain_semantic_entries(self.read()))
+
+    async def persist(self):
+        async with self.lock:
+            if not self.dirty:
+                return
+            entries = list(self.entries)
+            self.dirty = False
+        await asyncio.to_thread(self._write, entries)
+
+    def _write(self, entries: list[SemanticCacheEntry]):
+        # Every uvicorn worker persists to the same file. Under an exclusive lock,
+        # merge with what the other workers wrote (newest entry per question wins)
+        # and swap the result in with a single rename, so readers only ever see
+        # a complete file and no worker's entries are dropped.
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = {entry.key: entry for entry in self.read()}
+            for entry in entries:
+                if entry.key not in merged or merged[entry.key].created < entry.created:
+                    merged[entry.key] = entry
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(msgspec.msgpack.encode(retain_semantic_entries(list(merged.values()))))
+            os.replace(tmp_path, self.path)
+
+async def persist_semantic_cache_periodically(cache: SemanticCache):
+    while True:
+        await asyncio.sleep(SEMANTIC_CACHE_PERSIST_INTERVAL)
+        try:
+            await cache.prune()
+            await cache.persist()
+        except Exception as e:
+            logger.warning("Failed to persist semantic cache: %s", e)
+
+@app.on_event("startup")
+async def load_embedder():
+    app.state.semantic_cache = None
+    app.state.topic_embeddings = None
+    try:
+        embedder = await asyncio.to_thread(TextEmbedding, EMBEDDING_MODEL)
     except Exception as e:
-        print("\n=== Exception Details ===")
-        print(f"Exception Type: {type(e).__name__}")
-        print(f"Exception Message: {str(e)}")
-        print("Full Traceback:")
-        traceback.print_exc()
+        # The service still works without it; paraphrase hits and
+        # embedding-based classification fall back to Sonar
+        logger.warning("Embedding features disabled, could not load %s: %s", EMBEDDING_MODEL, e)
+        return
+    app.state.embedder = embedder
+    app.state.topic_embeddings = await asyncio.to_thread(embed, embedder, list(TOPIC_DESCRIPTIONS.values()))
+    cache = SemanticCache(embedder, SEMANTIC_CACHE_DIR)
+    await asyncio.to_thread(cache.load)
+    app.state.semantic_cache = cache
+    app.state.semantic_cache_persister = asyncio.create_task(persist_semantic_cache_periodically(cache))
+
+@app.on_event("shutdown")
+async def save_semantic_cache():
+    cache = app.state.semantic_cache
+    if cache is None:
+        return
+    app.state.semantic_cache_persister.cancel()
+    await cache.persist()
+
+def classify_topic_by_keywords(question: str) -> str | None:
+    matches = [topic for topic, pattern in TOPIC_KEYWORDS.items() if pattern.search(question)]
+    # Only trust the keywords when they point at a single topic
+    return matches[0] if len(matches) == 1 else None
+
+def topic_scores(vec: np.ndarray) -> dict[str, float]:
+    return dict(zip(TOPIC_DESCRIPTIONS, (vec @ app.state.topic_embeddings.T)[0].tolist()))
+
+async def classify_topic_locally(question: str, vec: np.ndarray | None = None) -> tuple[str | None, str | None]:
+    # Returns (topic, guess): topic (possibly "Unknown") when the local scores are
+    # confident, otherwise the best medical topic as a hint for speculation
+    if app.state.topic_embeddings is None:
+        return None, None
+    if vec is None:
+        vec = await asyncio.to_thread(embed, app.state.embedder, [question])
+    scores = topic_scores(vec)
+
+    keyword_topic = classify_topic_by_keywords(question)
+    if keyword_topic:
+        score = scores[keyword_topic]
+        if score >= LOCAL_CLASSIFIER_MIN_COSINE and score - scores["Unknown"] >= LOCAL_CLASSIFIER_MARGIN:
+            logger.debug("Keyword classification: %s (%.3f)", keyword_topic, score)
+            return keyword_topic, keyword_topic
+
+    (best, best_score), (_, runner_up_score) = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:2]
+    if best_score >= LOCAL_CLASSIFIER_MIN_COSINE and best_score - runner_up_score >= LOCAL_CLASSIFIER_MARGIN:
+        logger.debug("Embedding classification: %s (%.3f)", best, best_score)
+        return best, best if best != "Unknown" else None
+    guess = max((topic for topic in scores if topic != "Unknown"), key=scores.get)
+    return None, guess
+
+# Transient upstream failures are retried with jittered backoff; anything else
+# (including PoolTimeout and HTTP error statuses) fails immediately
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_random_exponential(min=0.5, max=4),
+    retry=retry_if_exception_type((httpx.ReadTimeout, httpx.RemoteProtocolError)),
+    reraise=True
+)
+async def send_to_sonar(body: bytes) -> httpx.Response:
+    return await app.state.sonar_client.post(SONAR_API_PATH, content=body)
+
+# Failures propagate unlogged; each caller logs them once with logger.exception
+async def post_to_sonar(payload: dict, label: str) -> CompletionResponse:
+    body = orjson.dumps(payload)
+    logger.debug("%s request url=%s payload=%s", label, SONAR_API_URL, body)
+    resp = await send_to_sonar(body)
+    # Read the raw bytes once for both logging and parsing; resp.text would decode the whole body
+    content = resp.content
+    logger.debug("%s response status=%s len=%d first=%s", label, resp.status_code, len(content), content[:200])
+    resp.raise_for_status()
+    return msgspec.json.decode(content, type=CompletionResponse)
+
+async def classify_topic_remote(question: str) -> str:
+    logger.debug("Classifying topic remotely: %s", question)
+    try:
+        payload = {
+            **_CLASSIFY_PAYLOAD_BASE,
+            "messages": [_CLASSIFY_SYSTEM_MESSAGE, {"role": "user", "content": question}]
+        }
+        result = await post_to_sonar(payload, "Classification")
+        topic = TopicFormat.model_validate(orjson.loads(result.choices[0].message.content))
+        logger.debug("Detected topic: %s", topic.topic_name)
+        return topic.topic_name
+    except Exception:
+        logger.exception("Topic classification failed")
         raise
 
-async def query_sonar(question: str, domains: list) -> CompletionResponse:
+async def classify_topics_remote(questions: list[str]) -> list[str]:
+    logger.debug("Classifying %d topics remotely", len(questions))
     try:
         payload = {
-                "model": "sonar-pro",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": question
-                    }
-                ],
-                "max_tokens": 5000,
-                "temperature": 0.2,
-                "top_p": 0.9,
-                "search_domain_filter": domains,
-                "return_images": False,
-                "return_related_questions": False,
-                "top_k": 0,
-                "stream": False,
-                "presence_penalty": 0,
-                "frequency_penalty": 1,
-                "web_search_options": {"search_context_size": "low"},
-                "chain_of_thought": True,
-                "include_citations": True
-            }
-
-        print(f"\n=== HTTP Request Details ===")
-        print(f"URL: {SONAR_API_URL}")
-        print(f"Payload: {json.dumps(payload, indent=2)}")
-
-        async with httpx.AsyncClient(timeout=httpx.Timeout(3000.0)) as client:
-            try:
-                resp = await client.post(
-                    SONAR_API_URL,
-                    headers={"Authorization": f"Bearer {SONAR_API_KEY}"},
-                    json=payload
-                )
-                print(f"\n=== HTTP Response Details ===")
-                print(f"Status Code: {resp.status_code}")
-                print(f"Response Text: {resp.text}...")
-                
-                resp.raise_for_status()
-                result = resp.json()
-                output = CompletionResponse.model_validate(result)
-                return output
-            except httpx.HTTPError as http_err:
-                print(f"\n=== HTTP Error Details ===")
-                print(f"HTTP Error occurred: {http_err}")
-                print(f"Error Response: {getattr(http_err, 'response', None)}")
-                print(f"Request Info: {getattr(http_err, 'request', None)}")
-                raise
-    except Exception as e:
-        print("\n=== Exception Details ===")
-        print(f"Exception Type: {type(e).__name__}")
-        print(f"Exception Message: {str(e)}")
-        print("Full Traceback:")
-        traceback.print_exc()
+            **_CLASSIFY_BATCH_PAYLOAD_BASE,
+            "max_tokens": 20 + 30 * len(questions),
+            "messages": [_CLASSIFY_BATCH_SYSTEM_MESSAGE, {"role": "user", "content": orjson.dumps(questions).decode()}]
+        }
+        result = await post_to_sonar(payload, "Batch classification")
+        topics = TopicBatchFormat.model_validate(orjson.loads(result.choices[0].message.content)).topic_names
+    except Exception:
+        logger.exception("Batch topic classification failed")
         raise
 
-@app.post("/ask", response_model=QueryResponse)
-async def ask_medical_question(req: QueryRequest):
-    print("Received request")
-    question = req.question
+    if len(topics) != len(questions):
+        logger.warning("Batch classification returned %d topics for %d questions, classifying individually", len(topics), len(questions))
+        return list(await asyncio.gather(*(classify_topic_remote(q) for q in questions)))
+    return topics
+
+class ClassifierBatcher:
+    # Collects remote classification requests arriving within a short window
+    # and sends them to Sonar as one batched call
+    def __init__(self, window: float = 0.025, max_batch: int = 8):
+        self.window = window
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue[tuple[str, asyncio.Future]] = asyncio.Queue()
+        self.dispatches: set[asyncio.Task] = set()
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        for task in [self.task, *self.dispatches]:
+            task.cancel()
+        await asyncio.gather(self.task, *self.dispatches, return_exceptions=True)
+
+    async def submit(self, question: str) -> str:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((question, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without waiting so the next window starts collecting right away
+            task = asyncio.create_task(self.dispatch(batch))
+            self.dispatches.add(task)
+            task.add_done_callback(self.dispatches.discard)
+
+    async def dispatch(self, batch: list[tuple[str, asyncio.Future]]):
+        questions = [question for question, _ in batch]
+        try:
+            if len(questions) == 1:
+                topics = [await classify_topic_remote(questions[0])]
+            else:
+                topics = await classify_topics_remote(questions)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), topic in zip(batch, topics):
+            if not future.done():
+                future.set_result(topic)
+
+@app.on_event("startup")
+async def start_classifier_batcher():
+    app.state.classifier_batcher = ClassifierBatcher()
+    app.state.classifier_batcher.start()
+
+@app.on_event("shutdown")
+async def stop_classifier_batcher():
+    await app.state.classifier_batcher.stop()
+
+# Unlogged, so a speculative query whose result is thrown away leaves no traceback
+async def fetch_sonar_answer(question: str, domains: tuple[str, ...]) -> SonarAnswer:
+    payload = {
+        **_QUERY_PAYLOAD_BASE,
+        "messages": [{"role": "user", "content": question}],
+        "search_domain_filter": domains
+    }
+    result = await post_to_sonar(payload, "Sonar")
+    return SonarAnswer(result.choices[0].message.content, result.citations)
+
+async def query_sonar(question: str, domains: tuple[str, ...]) -> SonarAnswer:
     try:
-        print("Classifying topic")
-        topic = await classify_topic(question)
+        return await fetch_sonar_answer(question, domains)
+    except Exception:
+        logger.exception("Sonar query failed")
+        raise
+
+def discard_speculative(task: asyncio.Task):
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and task.exception() is not None:
+        # Retrieve it so asyncio doesn't report "Task exception was never retrieved"
+        logger.debug("Discarded speculative Sonar query failed: %r", task.exception())
+
+async def stream_sonar(question: str, domains: tuple[str, ...]):
+    # Yields the decoded chunks of a streamed Sonar completion as they arrive
+    payload = {
+        **_QUERY_PAYLOAD_BASE,
+        "messages": [{"role": "user", "content": question}],
+        "search_domain_filter": domains,
+        "stream": True
+    }
+    body = orjson.dumps(payload)
+    logger.debug("Sonar stream request url=%s payload=%s", SONAR_API_URL, body)
+
+    async with app.state.sonar_client.stream("POST", SONAR_API_PATH, content=body) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            yield orjson.loads(data)
+
+def sse_event(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+def reject_out_of_scope(question: str):
+    if len(question.strip()) < MIN_QUESTION_LENGTH or _QUICK_REJECT.match(question):
+        raise HTTPException(status_code=400, detail="Unknown topic: Unknown")
+
+def question_cache_key(question: str) -> str:
+    return hashlib.sha1(question.strip().lower().encode()).hexdigest()
+
+async def answer_question(question: str, vec: np.ndarray | None = None) -> QueryResponse:
+    speculative = None
+    try:
+        topic, guess = await classify_topic_locally(question, vec)
+        if topic is None:
+            # Hide the Sonar classification round trip behind a speculative query
+            if guess in SPECULATIVE_TOPICS:
+                logger.debug("Speculatively querying Sonar for %s", guess)
+                speculative = asyncio.create_task(fetch_sonar_answer(question, DOMAIN_FILTERS_BY_TOPIC[guess]))
+            topic = await app.state.classifier_batcher.submit(question)
         domains = DOMAIN_FILTERS_BY_TOPIC.get(topic)
-        print("Domains", domains)
+        logger.debug("Topic %s -> domains %s", topic, domains)
         if not domains:
             raise HTTPException(status_code=400, detail=f"Unknown topic: {topic}")
 
-        print("Querying Sonar")
-        sonar_result = await query_sonar(question, domains)
-        print("Sonar result", sonar_result)
+        # Either way the task is handed off here, so the finally below skips it
+        task, speculative = speculative, None
+        if task is not None and topic == guess:
+            logger.debug("Using speculative Sonar query")
+            try:
+                sonar_result = await task
+            except Exception:
+                logger.exception("Sonar query failed")
+                raise
+        else:
+            if task is not None:
+                discard_speculative(task)
+            sonar_result = await query_sonar(question, domains)
         return QueryResponse(
             topic=topic,
             domain_filter=domains,
-            answer=sonar_result.choices[0].message.content,
+            answer=sonar_result.content,
             citations=sonar_result.citations
         )
 
+    except HTTPException:
+        raise
+    except httpx.PoolTimeout:
+        raise HTTPException(status_code=503, detail="Sonar API is saturated, please retry shortly")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if speculative is not None:
+            discard_speculative(speculative)
+
+async def answer_with_semantic_cache(question: str) -> QueryResponse:
+    cache = app.state.semantic_cache
+    if cache is None:
+        return await answer_question(question)
+
+    vec, cached = await cache.lookup(question)
+    if cached is not None:
+        logger.debug("Semantic cache hit")
+        return cached
+    response = await answer_question(question, vec)
+    await cache.add(vec, question_cache_key(question), response)
+    return response
+
+def abandon_pending(cache_key: str, future: asyncio.Future, e: BaseException):
+    # Never cache failures; wake any coalesced waiters with the same outcome
+    if RESPONSE_CACHE.get(cache_key) is future:
+        del RESPONSE_CACHE[cache_key]
+    if isinstance(e, asyncio.CancelledError):
+        future.cancel()
+    else:
+        future.set_exception(e)
+        future.exception()  # mark retrieved so asyncio doesn't warn when nobody waited
+
+async def await_cached_response(cache_key: str) -> QueryResponse | None:
+    # Returns the cached or in-flight answer, or None if the caller has to lead
+    while (cached := RESPONSE_CACHE.get(cache_key)) is not None:
+        logger.debug("Cache hit")
+        try:
+            return await asyncio.shield(cached)
+        except asyncio.CancelledError:
+            # A leader that was cancelled has already dropped its entry, so
+            # retry (and likely lead) rather than fail a request nobody cancelled
+            if not cached.cancelled() or asyncio.current_task().cancelling():
+                raise
+    return None
+
+async def answer_with_response_cache(question: str) -> QueryResponse:
+    cache_key = question_cache_key(question)
+    cached = await await_cached_response(cache_key)
+    if cached is not None:
+        return cached
+
+    future = asyncio.get_running_loop().create_future()
+    RESPONSE_CACHE[cache_key] = future
+    try:
+        response = await answer_with_semantic_cache(question)
+    except BaseException as e:
+        abandon_pending(cache_key, future, e)
+        raise
+    future.set_result(response)
+    return response
+
+# QueryResponse is encoded by msgspec directly, skipping FastAPI's Pydantic serialization
+@app.post(
+    "/ask",
+    response_class=MsgspecJSONResponse,
+    responses={200: {"content": {"application/json": {"schema": QUERY_RESPONSE_SCHEMA}}}}
+)
+async def ask_medical_question(req: QueryRequest):
+    question = req.question
+    reject_out_of_scope(question)
+    return MsgspecJSONResponse(await answer_with_response_cache(question))
+
+async def produce_answer_stream(question: str, topic: str, domains: tuple[str, ...], cache_key: str, future: asyncio.Future, vec: np.ndarray | None, events: asyncio.Queue):
+    # Runs detached from the client connection and owns the pending future, so a
+    # disconnect (even before the body is iterated) never strands coalesced waiters.
+    # SSE events: "meta" (topic, domains), "answer" (content deltas), then
+    # "done" (citations) or "error" (detail); None marks the end of the stream.
+    parts = []
+    citations = []
+    try:
+        events.put_nowait(sse_event("meta", {"topic": topic, "domain_filter": domains}))
+        async for chunk in stream_sonar(question, domains):
+            citations = chunk.get("citations") or citations
+            choices = chunk.get("choices")
+            content = choices[0].get("delta", {}).get("content") if choices else None
+            if content:
+                parts.append(content)
+                events.put_nowait(sse_event("answer", {"content": content}))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        logger.exception("Sonar stream failed")
+        abandon_pending(cache_key, future, HTTPException(status_code=500, detail=str(e)))
+        events.put_nowait(sse_event("error", {"detail": str(e)}))
+        events.put_nowait(None)
+        return
+    except BaseException:
+        # Cancelled at shutdown; waiters see a cancelled leader and retry
+        abandon_pending(cache_key, future, asyncio.CancelledError())
+        events.put_nowait(None)
+        raise
+
+    response = QueryResponse(topic=topic, domain_filter=domains, answer="".join(parts), citations=citations)
+    future.set_result(response)
+    events.put_nowait(sse_event("done", {"citations": citations}))
+    events.put_nowait(None)
+    cache = app.state.semantic_cache
+    if cache is not None and vec is not None:
+        await cache.add(vec, cache_key, response)
+
+async def relay_events(events: asyncio.Queue):
+    while (event := await events.get()) is not None:
+        yield event
+
+async def replay_answer(response: QueryResponse):
+    yield sse_event("meta", {"topic": response.topic, "domain_filter": response.domain_filter})
+    yield sse_event("answer", {"content": response.answer})
+    yield sse_event("done", {"citations": response.citations})
+
+# Shares the exact-match (including in-flight /ask calls) and semantic caches
+# with /ask, and registers its own in-flight answer so duplicates coalesce
+@app.post("/ask/stream")
+async def ask_medical_question_stream(req: QueryRequest):
+    question = req.question
+    reject_out_of_scope(question)
+    cache_key = question_cache_key(question)
+    cached = await await_cached_response(cache_key)
+    if cached is not None:
+        return StreamingResponse(replay_answer(cached), media_type="text/event-stream")
+
+    future = asyncio.get_running_loop().create_future()
+    RESPONSE_CACHE[cache_key] = future
+    try:
+        vec = None
+        cache = app.state.semantic_cache
+        if cache is not None:
+            vec, hit = await cache.lookup(question)
+            if hit is not None:
+                logger.debug("Semantic cache hit")
+                future.set_result(hit)
+                return StreamingResponse(replay_answer(hit), media_type="text/event-stream")
+
+        # Classify before streaming so an unknown topic is still a plain 400
+        try:
+            topic, _ = await classify_topic_locally(question, vec)
+            if topic is None:
+                topic = await app.state.classifier_batcher.submit(question)
+        except httpx.PoolTimeout:
+            raise HTTPException(status_code=503, detail="Sonar API is saturated, please retry shortly")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        domains = DOMAIN_FILTERS_BY_TOPIC.get(topic)
+        if not domains:
+            raise HTTPException(status_code=400, detail=f"Unknown topic: {topic}")
+    except BaseException as e:
+        abandon_pending(cache_key, future, e)
+        raise
+
+    events = asyncio.Queue()
+    task = asyncio.create_task(produce_answer_stream(question, topic, domains, cache_key, future, vec, events))
+    ANSWER_STREAM_TASKS.add(task)
+    task.add_done_callback(ANSWER_STREAM_TASKS.discard)
+    return StreamingResponse(relay_events(events), media_type="text/event-stream")
+
+# Registered last: shutdown hooks run in registration order, so the hooks above
+# can still log (e.g. a failed cache persist) before the listener drains and stops
+@app.on_event("shutdown")
+async def stop_log_listener():
+    log_listener.stop()